@@ -0,0 +1,57 @@
+'''Compare the numba bilinear kernel with pyresample on a small synthetic grid'''
+
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+pytest.importorskip('numba')
+pytest.importorskip('pyresample')
+
+import vito  # noqa: E402
+
+
+def get_bil_info(ny, nx, src_size, seed=0):
+    '''Generate random bilinear info of four neighbours'''
+    rng = np.random.default_rng(seed)
+    input_idxs = rng.random(src_size) > 0.2
+    size = ny * nx
+    # weights slightly outside [0, 1] like grid edges
+    t__ = rng.uniform(-0.01, 1.01, size)
+    s__ = rng.uniform(-0.01, 1.01, size)
+    t__[::17] = np.nan
+    idx_arr = rng.integers(0, input_idxs.sum(), (size, 4))
+    return t__, s__, input_idxs, idx_arr
+
+
+@pytest.mark.parametrize('field', ['uniform', 'random'])
+def test_numba_bilinear_matches_pyresample(field, monkeypatch):
+    monkeypatch.setattr(vito, 'resample_method', 'bilinear')
+    ny, nx = 20, 30
+    src_shape = (15, 25)
+    if field == 'uniform':
+        data = np.full(src_shape, 0.3, dtype=np.float32)
+    else:
+        data = np.random.default_rng(1).random(src_shape).astype(np.float32)
+    data[0, :3] = np.nan
+
+    emi = object.__new__(vito.vito)
+    emi.area_def = SimpleNamespace(shape=(ny, nx), size=ny*nx)
+    resample_info = get_bil_info(ny, nx, data.size)
+
+    expected = emi.get_bil_sample(data, resample_info)
+    result = emi.get_resample_sample(data, resample_info)
+
+    np.testing.assert_allclose(result, expected, rtol=1e-6)
+
+
+def test_numba_bilinear_checks_sizes(monkeypatch):
+    monkeypatch.setattr(vito, 'resample_method', 'bilinear')
+    data = np.ones((15, 25), dtype=np.float32)
+
+    emi = object.__new__(vito.vito)
+    emi.area_def = SimpleNamespace(shape=(20, 30), size=20*30)
+    t__, s__, input_idxs, idx_arr = get_bil_info(10, 30, data.size)
+
+    with pytest.raises(ValueError):
+        emi.get_resample_sample(data, (t__, s__, input_idxs, idx_arr))
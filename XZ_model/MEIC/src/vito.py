@@ -26,17 +26,30 @@ We will replace these species in wrfchemi* files
 
 '''
 
+import hashlib
 import logging
 import os
+import shutil
+import tempfile
+import zipfile
 from calendar import monthrange
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime, timedelta
-from time import strftime
 
 import numpy as np
+import pandas as pd
+import pyresample
 import xarray as xr
-from pyresample.bilinear import resample_bilinear
+from netCDF4 import Dataset
+from pyresample.bilinear import get_bil_info, get_sample_from_bil_info
 from pyresample.geometry import AreaDefinition, SwathDefinition
-from pyresample.kd_tree import resample_custom, resample_nearest
+from pyresample.kd_tree import (get_neighbour_info,
+                                get_sample_from_neighbour_info)
+
+try:
+    from numba import njit
+except ImportError:
+    njit = None
 
 # Choose the following line for info or debugging:
 # logging.basicConfig(level=logging.INFO)
@@ -46,9 +59,11 @@ logging.basicConfig(level=logging.DEBUG)
 data_path = '../input_files/'
 wrfchemi_dir = '../output_files/'
 output_dir = '../output_files/vito/'
+cache_dir = output_dir+'.resample_cache/'
 vito_filename = 'VITO_STD-RES-INVENTORY_EAST-CHINA.nc'
 domain = 'd01'
 resample_method = 'bilinear'  # nearest, bilinear or idw
+nthreads = 8  # number of threads for resampling hours
 
 # simulated date
 # emissions of any day in the month are same
@@ -71,9 +86,34 @@ wrf_projs = {1: 'lcc',
              }
 
 
+def apply_bilinear(data, index_array, t__, s__, data_min, data_max, out):
+    '''Apply bilinear weights of four neighbours to reduced 1d data
+
+    Same as pyresample's get_sample_from_bil_info, but in one pass
+        and invalid values are filled by 0 directly.
+    data_min and data_max should include the tolerance of pyresample (1e-6).
+    '''
+    for i in range(out.size):
+        t = t__[i]
+        s = s__[i]
+        value = (data[index_array[i, 0]] * (1 - s) * (1 - t) +
+                 data[index_array[i, 1]] * s * (1 - t) +
+                 data[index_array[i, 2]] * (1 - s) * t +
+                 data[index_array[i, 3]] * s * t)
+        if np.isnan(value) or value > data_max or value < data_min:
+            value = 0.
+        out[i] = value
+
+
+if njit is not None:
+    # release the GIL, then hours can be resampled by threads at same time
+    apply_bilinear = njit(nogil=True, cache=True)(apply_bilinear)
+
+
 class vito(object):
     def __init__(self, st, et, delta):
         self.get_info()
+        self.read_table()
         self.read_vito()
         self.resample_WRF(st, et, delta)
         self.replace_var()
@@ -113,10 +153,28 @@ class vito(object):
                                                    shape=shape)
         logging.info(f'Area: {self.area_def}')
 
+    def read_table(self, ):
+        '''Read the hourly factor table of emission kinds'''
+        self.kind = ['Fires', 'Industry', 'Energy', 'Residential', 'Traffic']
+        try:
+            # shape: 24*5 (time*kind)
+            table = np.genfromtxt('./hourly_factor.csv',
+                                  delimiter=',',
+                                  comments='#',
+                                  usecols=(0, 1, 2, 3, 4),
+                                  skip_header=2)
+            self.hourly_table = (table/(table.sum(axis=0)/24)).astype(np.float32)
+
+        except OSError:
+            logging.info(' '*8 +
+                         'hourly_factor.csv does not exist, use 1 instead')
+            self.hourly_table = np.ones((24, 5), dtype=np.float32)
+
     def read_vito(self, ):
         '''Read VITO data and convert to species in MOZART'''
-        # read VITO nc file
-        ds = xr.open_dataset(data_path+vito_filename)
+        # read VITO nc file lazily, one month per chunk
+        ds = xr.open_dataset(data_path+vito_filename,
+                             chunks={'time': 1, 'lat': -1, 'lon': -1})
 
         # molecular weights
         var_dict = {'E_NO': 14,
@@ -165,25 +223,17 @@ class vito(object):
         self.emi_lat = ds.coords['lat']
 
         # ref: https://github.com/Timothy-W-Hilton/STEMPyTools
-        lon_bounds2d, lat_bounds2d = np.meshgrid(self.emi_lon_b, self.emi_lat_b)
         EARTH_RADIUS = 6370000.0
         Rad_per_Deg = np.pi / 180.0
 
-        ydim = lon_bounds2d.shape[0]-1
-        xdim = lon_bounds2d.shape[1]-1
-        area = np.full((ydim, xdim), np.nan)
-        for j in range(ydim):
-            for i in range(xdim):
-                xlon1 = lon_bounds2d[j, i]
-                xlon2 = lon_bounds2d[j, i+1]
-                ylat1 = lat_bounds2d[j, i]
-                ylat2 = lat_bounds2d[j+1, i]
-
-                cap_ht = EARTH_RADIUS * (1 - np.sin(ylat1 * Rad_per_Deg))
-                cap1_area = 2 * np.pi * EARTH_RADIUS * cap_ht
-                cap_ht = EARTH_RADIUS * (1 - np.sin(ylat2 * Rad_per_Deg))
-                cap2_area = 2 * np.pi * EARTH_RADIUS * cap_ht
-                area[j, i] = abs(cap1_area - cap2_area) * abs(xlon1 - xlon2) / 360.0
+        # the area is the product of the spherical cap difference
+        #   between latitude bounds and the fraction of longitude
+        cap_area = 2 * np.pi * EARTH_RADIUS**2 * \
+            (1 - np.sin(self.emi_lat_b * Rad_per_Deg))
+        area = np.abs(np.diff(cap_area))[:, np.newaxis] * \
+            (np.abs(np.diff(self.emi_lon_b)) / 360.0)[np.newaxis, :]
+        # keep float32 as the emission data
+        area = area.astype(np.float32)
 
         # save to DataArray
         self.emi_area = xr.DataArray(area,
@@ -192,16 +242,6 @@ class vito(object):
                                              'lat': ds.coords['lat']}).rename('area')
         self.emi_area.attrs['units'] = 'm^2'
 
-        # assign to ds
-        lon2d, lat2d = np.meshgrid(ds.coords['lon'], ds.coords['lat'])
-        ds['longitude'] = xr.DataArray(lon2d,
-                                       coords=[ds.coords['lat'], ds.coords['lon']],
-                                       dims=['lat', 'lon'])
-        ds['latitude'] = xr.DataArray(lat2d,
-                                      coords=[ds.coords['lat'], ds.coords['lon']],
-                                      dims=['lat', 'lon'])
-
-
     def get_ds(self, ds, name, var_dict, mm):
         '''Generate the Dataset for species'''
         seconds = days*24*3600
@@ -214,55 +254,39 @@ class vito(object):
         else:
             varname = name.split('_')[-1]+'_Industry'
 
-        # subset data to selected month
+        # subset data to selected month first,
+        #   then only that month is read from disk and masked
+        ds = ds.isel(time=np.flatnonzero(ds['time.month'].values == mm))
         ds = ds.where(ds != ds[varname].attrs['MissingValue'])
-        ds = ds.where(ds['time.month'] == mm, drop=True)
 
+        # unit conversion factor (lat*lon),
+        #   applied to the summed species instead of each kind
         if name == 'E_PM25':
             # WRF-Chem unit: ug/m3 m/s
-            ds = ds*1e15/self.emi_area/(seconds*var_dict[name])
+            factor = np.float32(1e15)/self.emi_area.values/np.float32(seconds*var_dict[name])
 
         elif name in ['E_NO', 'E_SO2']:
             # WRF-Chem unit: mol km-2 hr-1
-            ds = ds*1e9/(self.emi_area/1e6)/(hours*var_dict[name])
-
-        # read hourly factor table
-        kind = ['Fires', 'Industry', 'Energy', 'Residential', 'Traffic']
-        try:
-            # shape: 24*5 (time*kind)
-            table = xr.DataArray(np.genfromtxt('./hourly_factor.csv',
-                                               delimiter=',',
-                                               comments='#',
-                                               usecols=(0, 1, 2, 3, 4),
-                                               skip_header=2),
-                                 dims=['hour', 'kind'],
-                                 coords={'hour': np.arange(0, 24, 1),
-                                         'kind': kind}
-                                 )
-            table = table/(table.sum(dim='hour')/24)
-
-        except OSError:
-            logging.info(' '*8 +
-                         'hourly_factor.csv does not exist, use 1 instead')
-            table = xr.DataArray(np.full((24, 5), 1),
-                                 dims=['hour', 'kind'],
-                                 coords={'hour': np.arange(0, 24, 1),
-                                         'kind': kind}
-                                 )
-
-        ds[name] = xr.DataArray(np.full((24, len(ds.lat), len(ds.lon)), 0.),
-                                dims=['hour', 'lat', 'lon']).rename(name)
+            factor = np.float32(1e9)/(self.emi_area.values/np.float32(1e6))/np.float32(hours*var_dict[name])
 
         # multiply data by hourly factor and sum to total
-        for k in kind:
-            ds[name] += (ds[varname.split('_')[-2]+'_'+k] * table.sel(kind=k)).squeeze('time')
-
-        # drop 'kind' variables
-        ds = ds.drop_vars([key for key in list(ds.keys()) if 'E_' not in key])
-        ds = ds.drop('kind')
+        #   shape: kind*lat*lon
+        stacked = np.stack([ds[varname.split('_')[-2]+'_'+k].squeeze('time').values
+                            for k in self.kind], axis=0)
+        #   tensordot uses BLAS: (hour*kind) x (kind*lat*lon) -> hour*lat*lon
+        result = np.tensordot(self.hourly_table,
+                              stacked.astype(np.float32, copy=False),
+                              axes=([1], [0])) * factor
+
+        # create new Dataset with the species only
+        ds = xr.Dataset({name: (('hour', 'lat', 'lon'), result)},
+                        coords={'lat': ds.lat, 'lon': ds.lon})
 
         # add longitude and latitude variables
-        lon2d, lat2d = np.meshgrid(ds.lon, ds.lat)
+        #   broadcast views instead of meshgrid copies
+        shape = (ds.sizes['lat'], ds.sizes['lon'])
+        lon2d = np.broadcast_to(ds.lon.values[np.newaxis, :], shape)
+        lat2d = np.broadcast_to(ds.lat.values[:, np.newaxis], shape)
 
         ds['longitude'] = xr.DataArray(lon2d,
                                        coords=[ds.lat, ds.lon],
@@ -279,81 +303,180 @@ class vito(object):
 
         return ds
 
-    def perdelta(self, start, end, delta):
-        '''Generate the 24-h datetime list'''
-        curr = start
-        while curr <= end:
-            yield curr
-            curr += delta
+    def get_resample_info(self, orig_def):
+        '''Calculate the resample info from emission grid to WRF area
+
+        The info only depends on the grids and resample method,
+            so it is saved to cache_dir and loaded directly in later runs.
+        '''
+        # parameters of pyresample which affect the resample info
+        neighbours = 1 if resample_method == 'nearest' else 10
+        epsilon = 0
+        reduce_data = True
+
+        grid_key = repr((pyresample.__version__,
+                         resample_method,
+                         self.radius_of_influence,
+                         neighbours,
+                         epsilon,
+                         reduce_data,
+                         self.area_def.proj_str,
+                         self.area_def.area_extent,
+                         self.area_def.shape,
+                         self.emi_lon_b.tolist(),
+                         self.emi_lat_b.tolist()))
+        cache_file = os.path.join(cache_dir,
+                                  resample_method+'_' +
+                                  hashlib.md5(grid_key.encode()).hexdigest()+'.npz')
+
+        try:
+            with np.load(cache_file) as cache:
+                resample_info = tuple(cache[f'arr_{i}'] for i in range(len(cache.files)))
+            self.check_resample_info(resample_info)
+            logging.info(f'Load resample info from {cache_file}')
+            return resample_info
+        except FileNotFoundError:
+            pass
+        except (OSError, EOFError, ValueError, zipfile.BadZipFile) as err:
+            # e.g. the file was truncated by a killed run,
+            #   or saved by another pyresample version with different layout
+            logging.warning(f'Failed to load {cache_file} ({err}), calculate it again')
+
+        # different resample methods
+        # see: http://earthpy.org/interpolation_between_grids_with_pyresample.html
+        if resample_method in ['nearest', 'idw']:
+            resample_info = get_neighbour_info(orig_def,
+                                               self.area_def,
+                                               self.radius_of_influence,
+                                               neighbours=neighbours,
+                                               epsilon=epsilon,
+                                               reduce_data=reduce_data)
+        elif resample_method == 'bilinear':
+            resample_info = get_bil_info(orig_def,
+                                         self.area_def,
+                                         radius=self.radius_of_influence,
+                                         neighbours=neighbours,
+                                         nprocs=4,
+                                         reduce_data=reduce_data,
+                                         segments=None,
+                                         epsilon=epsilon)
+
+        # write to a temporary file first and then rename it,
+        #   so a killed run does not leave a broken cache file
+        os.makedirs(cache_dir, exist_ok=True)
+        logging.info(f'Saving resample info to {cache_file}')
+        fd, tmp_file = tempfile.mkstemp(suffix='.npz', dir=cache_dir)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.savez(f, *resample_info)
+            os.replace(tmp_file, cache_file)
+        except BaseException:
+            os.remove(tmp_file)
+            raise
+
+        return resample_info
+
+    def get_resample_sample(self, data, resample_info):
+        '''Resample 2d emission data to WRF area using the resample info'''
+        if resample_method == 'nearest':
+            return get_sample_from_neighbour_info('nn',
+                                                  self.area_def.shape,
+                                                  data,
+                                                  *resample_info,
+                                                  fill_value=0.)
+        elif resample_method == 'idw':
+            return get_sample_from_neighbour_info('custom',
+                                                  self.area_def.shape,
+                                                  data,
+                                                  *resample_info,
+                                                  weight_funcs=lambda r: 1/r**2,
+                                                  fill_value=0.)
+        elif resample_method == 'bilinear':
+            if njit is None:
+                return self.get_bil_sample(data, resample_info)
+
+            # numba does not check bounds, so check the sizes before the kernel
+            self.check_resample_info(resample_info)
+            t__, s__, input_idxs, idx_arr = resample_info
+            data = data.ravel()[input_idxs]
+            result = np.empty(self.area_def.size, dtype=data.dtype)
+            # keep values within 1e-6 of the data range, as pyresample does
+            apply_bilinear(data, idx_arr, t__, s__,
+                           np.nanmin(data) - 1e-6, np.nanmax(data) + 1e-6,
+                           result)
+            return result.reshape(self.area_def.shape)
+
+    def check_resample_info(self, resample_info):
+        '''Check the shapes of resample info match the WRF area'''
+        if len(resample_info) != 4:
+            raise ValueError(f'Resample info should have 4 arrays, got {len(resample_info)}')
+
+        if resample_method in ['nearest', 'idw']:
+            valid_input_index, valid_output_index, index_array, distance_array = resample_info
+            if valid_output_index.size != self.area_def.size \
+                    or index_array.shape != distance_array.shape:
+                raise ValueError('Neighbour resample info does not match the WRF area: '
+                                 f'valid output {valid_output_index.shape}, '
+                                 f'index {index_array.shape}, distance {distance_array.shape}, '
+                                 f'area size {self.area_def.size}')
+
+        elif resample_method == 'bilinear':
+            t__, s__, input_idxs, idx_arr = resample_info
+            if not (t__.size == s__.size == idx_arr.shape[0] == self.area_def.size) \
+                    or idx_arr.ndim != 2 or idx_arr.shape[1] != 4:
+                raise ValueError('Bilinear resample info does not match the WRF area: '
+                                 f't {t__.shape}, s {s__.shape}, index {idx_arr.shape}, '
+                                 f'area size {self.area_def.size}')
+
+    def get_bil_sample(self, data, resample_info):
+        '''Resample 2d emission data by pyresample's bilinear function'''
+        result = get_sample_from_bil_info(data.ravel(),
+                                          *resample_info,
+                                          output_shape=self.area_def.shape)
+        result[np.isnan(result)] = 0.
+        return result
 
     def resample_WRF(self, st, et, delta):
         '''Create Times variable and resample emission species DataArray.'''
-        # generate date every hour
-        datetime_list = list(self.perdelta(st, et, timedelta(hours=1)))
+        # generate date string every hour
         t_format = '%Y-%m-%d_%H:%M:%S'
-
-        # convert datetime to date string
-        Times = []
-        for timstep in datetime_list:
-            times_str = strftime(t_format, timstep.timetuple())
-            Times.append(times_str)
+        Times = pd.date_range(st, et, freq=timedelta(hours=1)).strftime(t_format)
 
         # the method of creating "Times" with unlimited dimension
         # ref: htttps://github.com/pydata/xarray/issues/3407
-        Times = xr.DataArray(np.array(Times,
-                                      dtype=np.dtype(('S', 19))
-                                      ),
+        Times = xr.DataArray(Times.to_numpy(dtype=np.dtype(('S', 19))),
                              dims=['Time'])
 
         self.chemi = xr.Dataset({'Times': Times})
 
         # resample
-        orig_def = SwathDefinition(lons=self.emi['longitude'],
-                                   lats=self.emi['latitude'])
+        orig_def = SwathDefinition(lons=np.ascontiguousarray(self.emi['longitude'].values),
+                                   lats=np.ascontiguousarray(self.emi['latitude'].values))
+
+        # source and target grids are same for all species and hours,
+        #   so just calculate the resample info once
+        resample_info = self.get_resample_info(orig_def)
+
         for vname in self.emi.data_vars:
             if 'E_' in vname:
                 logging.info(f'Resample {vname} ...')
-                resampled_list = []
-                for t in range(self.emi[vname].shape[0]):
-                    # different resample methods
-                    # see: http://earthpy.org/interpolation_between_grids_with_pyresample.html
-                    if resample_method == 'nearest':
-                        resampled_list.append(resample_nearest(
-                                              orig_def,
-                                              self.emi[vname][t, :, :].values,
-                                              self.area_def,
-                                              radius_of_influence=self.radius_of_influence,
-                                              fill_value=0.)
-                                              )
-                    elif resample_method == 'idw':
-                        resampled_list.append(resample_custom(
-                                              orig_def,
-                                              self.emi[vname][t, :, :].values,
-                                              self.area_def,
-                                              radius_of_influence=self.radius_of_influence,
-                                              neighbours=10,
-                                              weight_funcs=lambda r: 1/r**2,
-                                              fill_value=0.)
-                                              )
-                    elif resample_method == 'bilinear':
-                        resampled_list.append(resample_bilinear(
-                                              self.emi[vname][t, :, :].values,
-                                              orig_def,
-                                              self.area_def,
-                                              radius=self.radius_of_influence,
-                                              neighbours=10,
-                                              nprocs=4,
-                                              reduce_data=True,
-                                              segments=None,
-                                              fill_value=0.,
-                                              epsilon=0)
-                                              )
-                # combine 2d array list to one 3d
-                # ref: https://stackoverflow.com/questions/4341359/
-                #       convert-a-list-of-2d-numpy-arrays-to-one-3d-numpy-array
-                # we also need to flip the 3d array,
-                #    because of the "strange" order of WRF.
-                resampled_data = np.flip(np.rollaxis(np.dstack(resampled_list), -1), 1)[:, np.newaxis, ...]
+                # get the ndarray once instead of indexing DataArray every hour
+                emi_data = np.ascontiguousarray(self.emi[vname].values)
+                ntime = emi_data.shape[0]
+
+                # write each hour into one 3d array directly,
+                #   flip the south_north axis because of the "strange" order of WRF.
+                ny, nx = self.area_def.shape
+                resampled_data = np.empty((ntime, ny, nx), dtype=np.float32)
+                # hours are independent, resample them in parallel
+                with ThreadPoolExecutor(max_workers=nthreads) as executor:
+                    futures = {executor.submit(self.get_resample_sample,
+                                               emi_data[t],
+                                               resample_info): t
+                               for t in range(ntime)}
+                    for future in as_completed(futures):
+                        resampled_data[futures[future], ::-1, :] = future.result()
+                resampled_data = resampled_data[:, np.newaxis, ...]
 
                 # assign to self.chemi with dims
                 self.chemi[vname] = xr.DataArray(resampled_data,
@@ -383,36 +506,33 @@ class vito(object):
 
     def replace_var(self, ):
         '''Replace variables in two wrfchemi* files: wrfchemi_00z_d<n> and wrfchemi_12z_d<n>'''
-        if not os.path.exists(output_dir):
-            os.makedirs(output_dir)
-
-        # set compression
-        comp = dict(zlib=True, complevel=5)
-        comp_t = dict(zlib=True, complevel=5, char_dim_name='DateStrLen')
+        os.makedirs(output_dir, exist_ok=True)
 
         # two period
         tindex = [np.arange(12), np.arange(12, 24, 1)]
 
         # generate files
+        #   copy files and only overwrite the replaced variables in place,
+        #   so other variables are not read and compressed again
         for index, file in enumerate([wrfchemi_dir+f'wrfchemi_00z_{domain}', wrfchemi_dir+f'wrfchemi_12z_{domain}']):
-            if os.path.isfile(file):
-                ds = xr.open_dataset(file)
-                ds['E_NO'] = self.chemi['E_NO'].isel(Time=tindex[index])
-                # ds['E_PM_25'] = self.chemi['E_PM25'].isel(Time=tindex[index])
-                ds['E_SO2'] = self.chemi['E_SO2'].isel(Time=tindex[index])
-
-                encoding = {var: comp_t if var == 'Times' else comp
-                            for var in ds.data_vars}
-
-                output_file = output_dir+os.path.basename(file)
-                logging.info(f'Saving to {output_file}')
-                ds.to_netcdf(f'{output_file}',
-                             format='NETCDF4',
-                             encoding=encoding,
-                             unlimited_dims={'Time': True}
-                             )
-            else:
+            output_file = output_dir+os.path.basename(file)
+            try:
+                shutil.copyfile(file, output_file)
+            except FileNotFoundError:
                 print('!!! Please run mozcart.py first !!!')
+            else:
+                logging.info(f'Saving to {output_file}')
+                with Dataset(output_file, 'a') as nc:
+                    for vname in ['E_NO', 'E_SO2']:  # 'E_PM25'
+                        var = self.chemi[vname].isel(Time=tindex[index])
+                        if vname not in nc.variables:
+                            # the species is not in the file, add it
+                            logging.info(f'Adding {vname} to {output_file}')
+                            nc.createVariable(vname, 'f4', var.dims,
+                                              zlib=True, complevel=1, shuffle=True)
+                        nc.variables[vname][:] = var.values
+                        # attrs needed by WRF-Chem, set in resample_WRF
+                        nc.variables[vname].setncatts(var.attrs)
 
         logging.info('----- Successfully -----')
 